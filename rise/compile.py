@@ -1,29 +1,215 @@
 from pathlib import Path
+import os
+import sys
+import mmap
 import subprocess
 import shutil
 from io import StringIO
 import json
+import struct
+import hashlib
+import sqlite3
 import xml.etree.ElementTree as ET
 from datetime import timedelta
-from tempfile import NamedTemporaryFile, TemporaryDirectory
+from math import gcd
+from argparse import ArgumentParser
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from threading import Thread
+from tempfile import TemporaryDirectory
 import numpy as np
+from scipy.io import wavfile
+from scipy.signal import sosfilt, resample_poly
 
 
 SRC_TRACKS_DIR = 'src-tracks'
+SRC_TRACKS_INDEX = 'src-tracks-index.json'
 SRC_TRACK_CONFIGS_DIR = 'src-track-configs'
+WEM_CATALOG = 'wem-catalog.db'
+UNPACK_PCK = Path(__file__).resolve().parent.parent / 'tools' / 'unpack_pck.py'
 TARGET_CONFIGS = {
     'staged_dir': 'target-configs/staged',
     'committed_dir': 'target-configs/committed',
 }
 TARGET_OUTPUT_DIR = 'outputs'
 IMAGES_DIR = 'images'
+RENDER_CACHE_DIR = 'render-cache'
+RENDER_CACHE_MAX_SIZE = 16 * 2**30
+# Sources in other formats are resampled and remixed to this sample rate and channel count
+SAMPLE_RATE = 48000
+CHANNELS = 2
+# Frames per rendered block, bounds the memory use independent of the compilation length
+BLOCK_FRAMES = 1 << 16
+# Fade in gain over the crossfade position x in [0, 1), the fade out uses 1 - x, named like the ffmpeg acrossfade curves
+CROSSFADE_CURVES = {
+    'tri': lambda x: x,
+    'qsin': lambda x: np.sin(np.pi / 2 * x),
+    'hsin': lambda x: (1 - np.cos(np.pi * x)) / 2,
+}
+# Length in s of the still image video segment that is repeated for the whole compilation
+STILL_SEGMENT_DURATION = 60
 
+# ITU-R BS.775 downmix to stereo, rows follow the WAVE channel order: quad FL FR BL BR, 5.1 FL FR FC LFE BL BR
+STEREO_DOWNMIX = {
+    4: [[1, 0], [0, 1], [0.7071, 0], [0, 0.7071]],
+    6: [[1, 0], [0, 1], [0.7071, 0.7071], [0, 0], [0.7071, 0], [0, 0.7071]],
+}
+
+
+HIRC_LOOP_FIELDS = ('fBeginTrimOffset', 'fEndTrimOffset', 'fSrcDuration')
+HIRC_CACHE_DTYPE = np.dtype([('sourceID', '<u4')] + [(name, '<f8') for name in HIRC_LOOP_FIELDS])
+HIRC_MUSIC_TRACK = 11
+
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as stream:
+        while chunk := stream.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def index_hirc_xml(path, index=None):
+    '''
+    Collect loop points per sourceID from a wwiser HIRC dump in a single streaming pass
+    '''
+    if index is None:
+        index = {}
+    # Fields seen so far for each currently open obj node
+    stack = []
+    for event, node in ET.iterparse(path, events=('start', 'end')):
+        if node.tag == 'obj':
+            if event == 'start':
+                stack.append({})
+                continue
+            fields = stack.pop()
+            if 'sourceID' in fields and all(name in fields for name in HIRC_LOOP_FIELDS):
+                loop_points = index.setdefault(fields['sourceID'], [])
+                loop_point = tuple(float(fields[name]) for name in HIRC_LOOP_FIELDS)
+                if loop_point not in loop_points:
+                    loop_points.append(loop_point)
+            # Like a './/fld' search, an obj node sees the first fields of its nested obj nodes
+            if stack:
+                for name, value in fields.items():
+                    stack[-1].setdefault(name, value)
+            node.clear()
+        elif event == 'end' and node.tag == 'fld' and stack:
+            name = node.attrib.get('na')
+            if name == 'sourceID' or name in HIRC_LOOP_FIELDS:
+                stack[-1].setdefault(name, node.attrib['va'])
+    return index
+
+
+def read_music_track(data, offset, end, version):
+    '''
+    Returns the (sourceID, *HIRC_LOOP_FIELDS) rows of the AkTrackSrcInfo playlist of a CAkMusicTrack object
+    '''
+    # Skip uFlags
+    offset += 1
+    num_sources, = struct.unpack_from('<I', data, offset)
+    offset += 4
+    source_ids = [0]
+    for _ in range(num_sources):
+        # AkBankSourceData: ulPluginID, StreamType, sourceID, uInMemoryMediaSize, uSourceBits
+        plugin_id, _, source_id = struct.unpack_from('<IBI', data, offset)
+        source_ids.append(source_id)
+        offset += 14
+        # Source plugins carry their parameters
+        if plugin_id & 0xF == 2:
+            size, = struct.unpack_from('<I', data, offset)
+            offset += 4 + size
+    num_items, = struct.unpack_from('<I', data, offset)
+    offset += 4
+    # Depending on the Wwise version trackID and sourceID are followed by up to two more ids (eventID, cacheID)
+    for num_ids in sorted(range(3), key=lambda num_ids: num_ids != (2 if version > 132 else 1)):
+        item_dtype = np.dtype(
+            [('trackID', '<u4'), ('sourceID', '<u4')] + [(f'id{i}', '<u4') for i in range(num_ids)]
+            + [('fPlayAt', '<f8')] + [(name, '<f8') for name in HIRC_LOOP_FIELDS]
+        )
+        if offset + num_items * item_dtype.itemsize > end:
+            continue
+        items = np.frombuffer(data[offset:offset + num_items * item_dtype.itemsize], dtype=item_dtype)
+        values = np.abs(np.stack([items[name] for name in ('fPlayAt', *HIRC_LOOP_FIELDS)]))
+        # Misaligned doubles show up as denormal or huge values
+        if (np.isin(items['sourceID'], source_ids).all() and np.isfinite(values).all()
+                and ((values == 0) | ((values > 1e-6) & (values < 1e9))).all() and (items['fSrcDuration'] > 0).all()):
+            return [(source_id, *loop_point) for source_id, *loop_point in items[['sourceID', *HIRC_LOOP_FIELDS]].tolist()]
+    raise ValueError(f'Unexpected music track layout at offset {offset}')
+
+
+def index_hirc_bank(path, index=None):
+    '''
+    Collect loop points per sourceID from the music track objects in the HIRC chunk of a sound bank
+    '''
+    if index is None:
+        index = {}
+    with path.open('rb') as stream, mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        # Banks are a sequence of chunks with 4 bytes tag and 4 bytes size
+        chunks = {}
+        offset = 0
+        while offset + 8 <= len(data):
+            tag, size = struct.unpack_from('<4sI', data, offset)
+            chunks[tag] = (offset + 8, size)
+            offset += 8 + size
+        if b'BKHD' not in chunks:
+            raise ValueError(f'{path} is not a sound bank')
+        version, = struct.unpack_from('<I', data, chunks[b'BKHD'][0])
+        if version <= 112:
+            raise ValueError(f'{path} has unsupported bank version {version}')
+        if b'HIRC' not in chunks:
+            return index
+        offset, _ = chunks[b'HIRC']
+        num_objects, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        for _ in range(num_objects):
+            obj_type, size = struct.unpack_from('<BI', data, offset)
+            offset += 5
+            # Object body starts with its id
+            if obj_type == HIRC_MUSIC_TRACK:
+                for source_id, *loop_point in read_music_track(data, offset + 4, offset + size, version):
+                    loop_points = index.setdefault(str(source_id), [])
+                    if tuple(loop_point) not in loop_points:
+                        loop_points.append(tuple(loop_point))
+            offset += size
+    return index
 
-def get_hirc_obj_attrib(obj_node, attrib, dtype=str):
-    try:
-        return dtype(obj_node.findall(f'.//fld[@na="{attrib}"]')[0].attrib['va'])
-    except IndexError:
-        return None
+
+def load_hirc(path, index):
+    '''
+    Add loop points of a wwiser HIRC dump or a sound bank to index
+    The table is cached as <file>.npz and only rebuilt when size/mtime and content hash of the file changed
+    '''
+    cache_path = path.with_name(f'{path.name}.npz')
+    stat = path.stat()
+    stamp = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    loop_table = None
+    digest = None
+    if cache_path.exists():
+        with np.load(cache_path) as cache:
+            if np.array_equal(cache['stamp'], stamp):
+                loop_table = cache['loop_table']
+            else:
+                # Touched, but possibly unchanged dump
+                digest = hash_file(path)
+                if str(cache['digest']) == digest:
+                    loop_table = cache['loop_table']
+    rebuild = loop_table is None
+    if rebuild:
+        loop_points = index_hirc_xml(path) if path.suffix == '.xml' else index_hirc_bank(path)
+        loop_table = np.array([
+            (int(source_id), *loop_point)
+            for source_id, points in loop_points.items()
+            for loop_point in points
+        ], dtype=HIRC_CACHE_DTYPE)
+    if rebuild or digest is not None:
+        with cache_path.open('wb') as stream:
+            np.savez(stream, loop_table=loop_table, stamp=stamp, digest=np.array(digest or hash_file(path)))
+    for source_id, *loop_point in loop_table.tolist():
+        loop_points = index.setdefault(str(source_id), [])
+        if tuple(loop_point) not in loop_points:
+            loop_points.append(tuple(loop_point))
+    return index
 
 
 def get_range(hirc_id):
@@ -38,24 +224,16 @@ def get_range(hirc_id):
         return (end, begin, end-begin)
     # Extract loop points from HIRC for given soundtrack hirc_id
     loop_points = set()
-    for tree in get_range.hirc_xml_trees:
-        for obj_node in tree.findall('.//obj'):
-            if hirc_id != get_hirc_obj_attrib(obj_node, "sourceID"):
-                continue
-            begin = get_hirc_obj_attrib(obj_node, "fBeginTrimOffset", dtype=float)
-            if begin is None:
-                continue
-            begin /= 1e3
-            end = get_hirc_obj_attrib(obj_node, "fEndTrimOffset", dtype=float)
-            end /= 1e3
-            src_duration = get_hirc_obj_attrib(obj_node, "fSrcDuration", dtype=float)
-            src_duration /= 1e3
-            # Handle negative values
-            if begin < 0:
-                begin += src_duration
-            if end <= 0:
-                end += src_duration
-            loop_points.add((begin, end))
+    for begin, end, src_duration in get_range.hirc_index.get(hirc_id, []):
+        begin /= 1e3
+        end /= 1e3
+        src_duration /= 1e3
+        # Handle negative values
+        if begin < 0:
+            begin += src_duration
+        if end <= 0:
+            end += src_duration
+        loop_points.add((begin, end))
     if not loop_points:
         raise RuntimeError(hirc_id)
     # Get best loop point, i.e. longest interval
@@ -70,70 +248,583 @@ def get_range(hirc_id):
 
       
 # Load HIRC configs for soundtrack range getter
-get_range.hirc_xml_trees = []
+get_range.hirc_index = {}
 for path in Path(SRC_TRACK_CONFIGS_DIR).glob('*.xml'):
-    get_range.hirc_xml_trees.append(ET.parse(path))
+    load_hirc(path, get_range.hirc_index)
+# Sound banks are read directly, e.g. *_str*.bnk.* and *_cmn.nbnk.*
+for path in Path(SRC_TRACK_CONFIGS_DIR).glob('*.*bnk*'):
+    if path.suffix != '.npz':
+        load_hirc(path, get_range.hirc_index)
 get_range.hirc_dict = {}
 for path in Path(SRC_TRACK_CONFIGS_DIR).glob('*.json'):
     with path.open('r') as stream:
         get_range.hirc_dict.update(json.load(stream))
 
 
-def ffmpeg(*inputs, output_file=None, pre_options=(), options=(), stderr=None):
+def ffmpeg(*inputs, output_file=None, pre_options=(), input_options=(), options=(), stderr=None, stdin=None):
     cml = ['ffmpeg', '-y']
     cml.extend(pre_options)
-    for input_file in inputs:
+    for index, input_file in enumerate(inputs):
+        # Options that only apply to the input at the same position
+        if index < len(input_options):
+            cml.extend(input_options[index])
         cml.extend(['-i', input_file])
     cml.extend(options)
     if output_file is None:
         cml.extend(['-f', 'null', '-'])
-        response = subprocess.check_output(cml, stderr=stderr)
+        response = subprocess.check_output(cml, stderr=stderr, stdin=stdin)
     else:
         with TemporaryDirectory() as tmp_dir:
             tmp_out = Path(tmp_dir) / output_file.name
             cml.append(tmp_out)
-            response = subprocess.check_output(cml, stderr=stderr)
+            response = subprocess.check_output(cml, stderr=stderr, stdin=stdin)
             shutil.move(tmp_out, output_file)
     return StringIO(response.decode('utf8'))
 
 
-def normalize_audio(input_file, output_file=None, target_lufs=-14.0):
+def read_wav(path):
     '''
-    Loudnorm to -14 LUFS by default (Recommended by YouTube)
+    Memory-map a WAV file, returns sample rate and samples as (frames, channels) array
     '''
-    subprocess.check_output(['ffmpeg-normalize', '-f', '-nt', 'ebu', '-t', str(target_lufs), '--keep-loudness-range-target', input_file, '-o', output_file])
+    rate, samples = wavfile.read(path, mmap=True)
+    if samples.ndim == 1:
+        samples = samples[:, np.newaxis]
+    return rate, samples
 
 
-def set_mean_volume(input_file, output_file=None, target=-14.0):
-    response = ffmpeg(input_file, options=['-af', 'volumedetect'], stderr=subprocess.STDOUT)
-    for line in response:
-        if 'mean_volume' in line:
-            break
-    volume_offset = target - float(line.split()[-2])
-    ffmpeg(input_file, output_file=input_file, options=['-af', f'volume={volume_offset}dB'], stderr=subprocess.DEVNULL)
+def iter_chunks(samples, chunk_frames=1 << 20):
+    for offset in range(0, len(samples), chunk_frames):
+        yield samples[offset:offset + chunk_frames]
 
 
-def join_audio(*inputs, output_file=None, crossfade=None):
-    if crossfade is None:
-        ffmpeg(*inputs, output_file=output_file, options=['-filter_complex', '[0:0][1:0]concat=n=2:v=0:a=1[out]', '-map', '[out]'], stderr=subprocess.DEVNULL)
-    else:
-        ffmpeg(*inputs, output_file=output_file, options=['-filter_complex', f'acrossfade=d={crossfade}'], stderr=subprocess.DEVNULL)
+def to_float(samples):
+    '''
+    Convert PCM samples to float32 in [-1.0, 1.0]
+    '''
+    if samples.dtype.kind == 'f':
+        return samples.astype(np.float32)
+    if samples.dtype == np.uint8:
+        return (samples.astype(np.float32) - 128) / 128
+    return samples.astype(np.float32) / -np.iinfo(samples.dtype).min
+
+
+class WavWriter:
+    '''
+    Append-only 16-bit PCM or 32-bit float WAV writer, the header sizes are patched on close
+    Pipes and files beyond 4 GiB get the size 0xFFFFFFFF, which ffmpeg reads up to EOF
+    '''
 
+    def __init__(self, path, rate, channels, float32=False):
+        self.stream = open(path, 'wb')
+        self.seekable = self.stream.seekable()
+        self.rate = rate
+        self.channels = channels
+        self.float32 = float32
+        self.frames = 0
+        self.stream.write(self.header())
 
-def cut_audio(input_file, output_file=None, begin=0.0, duration=0.0):
-    ffmpeg(input_file, output_file=output_file, options=['-ss', str(begin), '-t', str(duration)], stderr=subprocess.DEVNULL)
+    def header(self):
+        sample_size = 4 if self.float32 else 2
+        block_align = sample_size * self.channels
+        if self.seekable and self.frames * block_align <= 0xFFFFFFFF - 36:
+            data_size = self.frames * block_align
+            riff_size = 36 + data_size
+        else:
+            # Pipes and files beyond 4 GiB have no valid size, ffmpeg reads a data chunk of size 0xFFFFFFFF up to EOF
+            data_size = riff_size = 0xFFFFFFFF
+        # Format tag 3 is IEEE float, 1 is integer PCM
+        format_tag = 3 if self.float32 else 1
+        return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', riff_size, b'WAVE', b'fmt ', 16, format_tag, self.channels, self.rate, self.rate * block_align, block_align, 8 * sample_size, b'data', data_size)
 
+    def write(self, block):
+        '''
+        Append a float block of shape (frames, channels), 16-bit output is clipped to [-1.0, 1.0)
+        '''
+        if self.float32:
+            self.write_pcm(block.astype('<f4'))
+        else:
+            self.write_pcm(np.clip(np.rint(block * 32768), -32768, 32767).astype('<i2'))
+
+    def write_pcm(self, pcm):
+        self.stream.write(pcm.tobytes())
+        self.frames += len(pcm)
+
+    def close(self):
+        if self.seekable:
+            self.stream.seek(0)
+            self.stream.write(self.header())
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BlockProducer(Thread):
+    '''
+    Writes float blocks as WAV into a pipe while ffmpeg reads the other end as stdin
+    Entering starts the thread, leaving closes the read end and waits for the thread
+    '''
+
+    def __init__(self, blocks, rate, channels):
+        super().__init__()
+        self.blocks = blocks
+        self.rate = rate
+        self.channels = channels
+        self.read_fd, self.write_fd = os.pipe()
+        self.error = None
+
+    def run(self):
+        try:
+            with WavWriter(self.write_fd, self.rate, self.channels) as writer:
+                for block in self.blocks:
+                    writer.write(block)
+        except BrokenPipeError:
+            # The encoder stopped early and reports its own error
+            pass
+        except Exception as error:
+            self.error = error
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        os.close(self.read_fd)
+        self.join()
+
+
+def cut_samples(samples, rate, begin=0.0, duration=0.0):
+    '''
+    Returns a view of the samples in the given range (in s)
+    '''
+    start = max(round(begin * rate), 0)
+    return samples[start:start + round(duration * rate)]
+
+
+def iter_blocks(segments, fadeout=0, block_frames=BLOCK_FRAMES):
+    '''
+    Yield consecutive segments as float blocks of block_frames frames (the last one may be shorter),
+    the last fadeout frames get a linear fadeout
+    Samples are only read from the memory-mapped segments when their block is emitted
+    '''
+    frames = sum(len(segment) for segment in segments)
+    fade_begin = frames - fadeout
 
-def fadeout_audio(input_file, output_file=None, begin=0.0, duration=0.0):
-    ffmpeg(input_file, output_file=output_file, options=['-af', f'afade=out:st={begin}:d={duration}'], stderr=subprocess.DEVNULL)
+    def get_block(pieces, position):
+        block = to_float(np.concatenate(pieces) if len(pieces) > 1 else pieces[0])
+        if position + len(block) > fade_begin:
+            offset = max(fade_begin - position, 0)
+            ramp = (frames - np.arange(position + offset, position + len(block))) / fadeout
+            block[offset:] *= ramp[:, np.newaxis]
+        return block
+
+    pieces = []
+    filled = 0
+    position = 0
+    for segment in segments:
+        offset = 0
+        while offset < len(segment):
+            piece = segment[offset:offset + block_frames - filled]
+            pieces.append(piece)
+            offset += len(piece)
+            filled += len(piece)
+            if filled == block_frames:
+                yield get_block(pieces, position)
+                position += filled
+                pieces = []
+                filled = 0
+    if pieces:
+        yield get_block(pieces, position)
+
+
+def get_k_weighting(rate):
+    '''
+    ITU-R BS.1770 K-weighting filter (high shelf and high pass) for the given sample rate as second-order sections
+    '''
+    # High shelf
+    K = np.tan(np.pi * 1681.974450955533 / rate)
+    Q = 0.7071752369554196
+    Vh = 10 ** (3.999843853973347 / 20)
+    Vb = Vh ** 0.4996667741545416
+    a0 = 1 + K / Q + K * K
+    shelf = [(Vh + Vb * K / Q + K * K) / a0, 2 * (K * K - Vh) / a0, (Vh - Vb * K / Q + K * K) / a0, 1.0, 2 * (K * K - 1) / a0, (1 - K / Q + K * K) / a0]
+    # High pass
+    K = np.tan(np.pi * 38.13547087602444 / rate)
+    Q = 0.5003270373238773
+    a0 = 1 + K / Q + K * K
+    high_pass = [1.0, -2.0, 1.0, 1.0, 2 * (K * K - 1) / a0, (1 - K / Q + K * K) / a0]
+    return np.array([shelf, high_pass])
+
+
+def get_channel_weights(channels):
+    # LFE is ignored and surround channels are weighted with +1.5 dB in 5.1
+    return np.array([1.0, 1.0, 1.0, 0.0, 1.41, 1.41]) if channels == 6 else np.ones(channels)
+
+
+def get_integrated_loudness(steps):
+    '''
+    ITU-R BS.1770 gated integrated loudness from K-weighted mean squares per 100 ms step and channel
+    '''
+    if len(steps) < 4:
+        return None
+    # Gating blocks of 400 ms overlap by 75 %
+    power = (steps[:-3] + steps[1:-2] + steps[2:-1] + steps[3:]) / 4 @ get_channel_weights(steps.shape[1])
+    with np.errstate(divide='ignore'):
+        loudness = -0.691 + 10 * np.log10(power)
+    # Absolute gate at -70 LUFS, relative gate 10 LU below the absolute-gated loudness
+    gated = loudness > -70
+    if not gated.any():
+        return None
+    gated &= loudness > -0.691 + 10 * np.log10(power[gated].mean()) - 10
+    return -0.691 + 10 * np.log10(power[gated].mean())
+
+
+def get_stats_loudness(stats, measure='lufs'):
+    '''
+    Integrated loudness in LUFS or mean volume in dB (like ffmpeg's volumedetect) of loudness statistics
+    '''
+    if measure == 'lufs':
+        steps = stats['steps']
+        return get_integrated_loudness(steps[:, steps.shape[1] // 2:])
+    if stats['energy'] == 0:
+        return None
+    return 10 * np.log10(stats['energy'] / stats['count'])
+
+
+class LoudnessMeter:
+    '''
+    Streaming loudness measurement of float blocks
+    Collects the signal energy and, per 100 ms step, the plain and K-weighted mean square of every channel
+    '''
+
+    def __init__(self, rate, channels):
+        self.rate = rate
+        self.energy = 0.0
+        self.count = 0
+        self.sos = get_k_weighting(rate)
+        self.zi = np.zeros((len(self.sos), 2, channels))
+        self.step = round(0.1 * rate)
+        self.remainder = np.zeros((0, 2 * channels))
+        self.steps = []
+
+    def add(self, block):
+        flat = block.ravel()
+        self.energy += float(np.dot(flat, flat))
+        self.count += len(flat)
+        weighted, self.zi = sosfilt(self.sos, block, axis=0, zi=self.zi)
+        block = np.concatenate([self.remainder, np.concatenate([block, weighted], axis=1)])
+        n_steps = len(block) // self.step
+        self.steps.append(np.square(block[:n_steps * self.step]).reshape(n_steps, self.step, block.shape[1]).mean(axis=1))
+        self.remainder = block[n_steps * self.step:]
+
+    def get_stats(self, gain=1.0):
+        '''
+        Loudness statistics of the measured blocks after applying gain
+        '''
+        steps = np.concatenate(self.steps) if self.steps else np.zeros((0, self.remainder.shape[1]))
+        return {
+            'rate': self.rate,
+            'step': self.step,
+            'energy': self.energy * gain ** 2,
+            'count': self.count,
+            'steps': steps * gain ** 2,
+        }
+
+    def loudness(self, measure='lufs'):
+        return get_stats_loudness(self.get_stats(), measure=measure)
+
+
+def combine_loudness_stats(stats, crossfades, curves=None):
+    '''
+    Loudness statistics of consecutive entries, crossfades gives the overlap (in s) of each entry with its predecessor
+    Overlapping steps are mixed with the fades of curves (default tri), assuming uncorrelated signals
+    '''
+    curves = curves or ['tri'] * len(stats)
+    rate = int(stats[0]['rate'])
+    step = int(stats[0]['step'])
+    energy = 0.0
+    count = 0
+    steps = []
+    for entry_stats, crossfade, curve in zip(stats, crossfades, curves):
+        energy += float(entry_stats['energy'])
+        count += int(entry_stats['count'])
+        head = entry_stats['steps']
+        overlap = min(round(crossfade * rate / step), len(head), len(steps[-1])) if steps else 0
+        if overlap:
+            tail = steps[-1][-overlap:]
+            x = ((np.arange(overlap) + 0.5) / overlap)[:, np.newaxis]
+            mixed = tail * CROSSFADE_CURVES[curve](1 - x) ** 2 + head[:overlap] * CROSSFADE_CURVES[curve](x) ** 2
+            # Replace the energy of both overlapping parts by the energy of their mix
+            channels = head.shape[1] // 2
+            energy += float((mixed - tail - head[:overlap])[:, :channels].sum()) * step
+            count -= round(crossfade * rate) * channels
+            steps[-1] = np.concatenate([steps[-1][:-overlap], mixed])
+            head = head[overlap:]
+        steps.append(head)
+    return {'rate': rate, 'step': step, 'energy': energy, 'count': count, 'steps': np.concatenate(steps)}
+
+
+def get_gain(loudness, target=-14.0):
+    return 1.0 if loudness is None else 10 ** ((target - loudness) / 20)
+
+
+def measure_entry(segments, rate, fadeout=0, target=-14.0, measure='lufs', block_frames=BLOCK_FRAMES):
+    '''
+    Measure the faded segments, returns the gain that sets their loudness to target (in LUFS or dB, see measure)
+    and the loudness statistics after applying it
+    '''
+    meter = LoudnessMeter(rate, segments[0].shape[1])
+    for block in iter_blocks(segments, fadeout=fadeout, block_frames=block_frames):
+        meter.add(block)
+    gain = get_gain(meter.loudness(measure), target=target)
+    return gain, meter.get_stats(gain)
+
+
+def normalize_audio(input_file, output_file=None, target=-14.0, measure='lufs'):
+    '''
+    Set the loudness to -14 LUFS by default (Recommended by YouTube)
+    '''
+    rate, samples = read_wav(input_file)
+    meter = LoudnessMeter(rate, samples.shape[1])
+    for chunk in iter_chunks(samples):
+        meter.add(to_float(chunk))
+    gain = get_gain(meter.loudness(measure), target=target)
+    tmp_file = Path(output_file).with_suffix('.tmp')
+    with WavWriter(tmp_file, rate, samples.shape[1]) as writer:
+        for chunk in iter_chunks(samples):
+            writer.write(to_float(chunk) * gain)
+    # Release the memory map before replacing a file that may be the input
+    del samples
+    os.replace(tmp_file, output_file)
+
+
+def scan_src_tracks(directory, listings, cached_listings):
+    '''
+    Collect the WAV files and subdirectories of directory and below into listings
+    Cached listings are reused for directories whose mtime did not change
+    '''
+    mtime = directory.stat().st_mtime_ns
+    listing = cached_listings.get(str(directory))
+    if listing is None or listing['mtime'] != mtime:
+        listing = {'mtime': mtime, 'dirs': [], 'files': []}
+        for item in os.scandir(directory):
+            if item.is_dir():
+                listing['dirs'].append(item.name)
+            elif item.name.endswith('.wav'):
+                listing['files'].append(item.name)
+    listings[str(directory)] = listing
+    for name in listing['dirs']:
+        scan_src_tracks(directory / name, listings, cached_listings)
+    return listings
+
+
+def index_src_tracks():
+    '''
+    Map track ids to their WAV file below SRC_TRACKS_DIR, the directory listings are persisted in SRC_TRACKS_INDEX
+    '''
+    if not Path(SRC_TRACKS_DIR).is_dir():
+        return {}
+    cached_listings = {}
+    if Path(SRC_TRACKS_INDEX).exists():
+        with open(SRC_TRACKS_INDEX, 'r') as stream:
+            cached_listings = json.load(stream)
+    listings = scan_src_tracks(Path(SRC_TRACKS_DIR), {}, cached_listings)
+    if listings != cached_listings:
+        tmp_path = f'{SRC_TRACKS_INDEX}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as stream:
+            json.dump(listings, stream)
+        os.replace(tmp_path, SRC_TRACKS_INDEX)
+    candidates = {}
+    for directory, listing in listings.items():
+        for name in listing['files']:
+            candidates.setdefault(name[:-len('.wav')], []).append(Path(directory) / name)
+    paths = {}
+    for track_id, track_paths in candidates.items():
+        paths[track_id] = min(track_paths)
+        if len(track_paths) > 1:
+            print(f'Warning: {track_id}.wav exists in {", ".join(str(path.parent) for path in sorted(track_paths))}, using {paths[track_id]}')
+    return paths
+
+
+def pull_src_track(track_id):
+    '''
+    Extract a track missing from SRC_TRACKS_DIR from the pck file listed in WEM_CATALOG
+    The converted WAV file is kept in SRC_TRACKS_DIR for later runs
+    '''
+    if not track_id.isdigit() or not Path(WEM_CATALOG).exists():
+        return None
+    with closing(sqlite3.connect(WEM_CATALOG)) as catalog:
+        row = catalog.execute('SELECT pck FROM wems WHERE id = ? ORDER BY pck LIMIT 1', (int(track_id),)).fetchone()
+    if row is None:
+        return None
+    pck_path = Path(row[0])
+    out_path = Path(SRC_TRACKS_DIR).resolve()
+    out_path.mkdir(exist_ok=True)
+    print(f'Log: Extracting {track_id}.wav from {pck_path.name}..')
+    # unpack_pck.py locates ww2ogg relative to its directory
+    subprocess.run([sys.executable, UNPACK_PCK.name, pck_path, '-o', out_path, '--ids', track_id], cwd=UNPACK_PCK.parent, check=True, stdout=subprocess.DEVNULL)
+    return out_path / pck_path.stem / f'{track_id}.wav'
 
 
-def load_and_process_entry(entry, output_file=None):
+def find_src_track(track_id, layer_gains=None):
+    if find_src_track.paths is None:
+        find_src_track.paths = index_src_tracks()
+    # Composite ids like 'a+b' are mixed from their layers, unless a premixed file exists
+    if '+' in track_id and track_id not in find_src_track.paths:
+        return mix_layers(track_id.split('+'), gains=layer_gains)
+    if track_id not in find_src_track.paths:
+        path = pull_src_track(track_id)
+        if path is not None:
+            find_src_track.paths[track_id] = path
     try:
-        path = list(Path(SRC_TRACKS_DIR).rglob(f'{entry["id"]}.wav'))[0]
-    except IndexError:
-        print(f'{entry["id"]}.wav')
+        path = find_src_track.paths[track_id]
+    except KeyError:
+        print(f'{track_id}.wav')
         raise
+    return harmonize_src_track(path)
+
+
+find_src_track.paths = None
+
+
+def set_src_tracks(paths):
+    '''
+    Worker initializer, hands the index built once by the parent to find_src_track
+    '''
+    find_src_track.paths = paths
+
+
+def probe_wav(path):
+    '''
+    Returns sample rate and channel count from the fmt chunk of a WAV file
+    '''
+    with open(path, 'rb') as stream:
+        stream.seek(12)
+        while header := stream.read(8):
+            tag, size = struct.unpack('<4sI', header)
+            if tag == b'fmt ':
+                _, channels, rate = struct.unpack('<HHI', stream.read(8))
+                return rate, channels
+            # Chunks are padded to an even size
+            stream.seek(size + size % 2, 1)
+    raise ValueError(f'{path} has no fmt chunk')
+
+
+def get_remix_matrix(source_channels, channels):
+    '''
+    Returns the (source_channels, channels) matrix mapping source channels to output channels
+    Quad and 5.1 use STEREO_DOWNMIX, other counts fold surplus channels onto the outputs in order or repeat the source channels
+    '''
+    if channels <= 2 and source_channels in STEREO_DOWNMIX:
+        matrix = np.array(STEREO_DOWNMIX[source_channels])
+        if channels == 1:
+            matrix = matrix.sum(axis=1, keepdims=True)
+    else:
+        matrix = np.zeros((source_channels, channels))
+        for index in range(max(source_channels, channels)):
+            matrix[index % source_channels, index % channels] = 1
+    # Unit gain per output channel, a downmix never clips
+    return matrix / matrix.sum(axis=0)
+
+
+def remix_channels(samples, channels):
+    if samples.shape[1] == channels:
+        return samples
+    return (samples @ get_remix_matrix(samples.shape[1], channels)).astype(np.float32)
+
+
+def iter_harmonized(samples, channels, up, down, block_frames=BLOCK_FRAMES):
+    '''
+    Remix and resample by up/down in blocks, yields the same samples as a single resample_poly call over the whole source
+    Blocks start at multiples of down and overlap by the half-length of the resampling filter, so every block keeps the filter state at its edges
+    '''
+    step = max(block_frames // down, 1) * down
+    # resample_poly uses a filter of half-length 10 * max(up, down) at the upsampled rate
+    margin = 0 if up == down else -(-(10 * max(up, down) // up + 1) // down) * down
+    for start in range(0, len(samples), step):
+        end = min(start + step, len(samples))
+        low = max(start - margin, 0)
+        block = remix_channels(to_float(samples[low:end + margin]), channels)
+        if up != down:
+            # Polyphase FIR resampling with a Kaiser window
+            block = resample_poly(block, up, down, axis=0)
+        first = (start - low) * up // down
+        yield block[first:first + -(-end * up // down) - start * up // down]
+
+
+def harmonize_src_track(path, rate=SAMPLE_RATE, channels=CHANNELS):
+    '''
+    Returns path if the source has the given sample rate and channel count, otherwise a resampled and remixed copy
+    The copy is made once and kept in the render cache under the source hash and target format, as float to keep resampling overshoot
+    '''
+    if path in harmonize_src_track.paths:
+        return harmonize_src_track.paths[path]
+    harmonized_path = path
+    if probe_wav(path) != (rate, channels):
+        key = hashlib.sha1(json.dumps([hash_file(path), rate, channels, 'float32']).encode('utf8')).hexdigest()
+        harmonized_path = Path(RENDER_CACHE_DIR) / f'{key}.wav'
+        if harmonized_path.exists():
+            # The modification time tracks the last use for eviction
+            harmonized_path.touch()
+        else:
+            source_rate, samples = read_wav(path)
+            divisor = gcd(rate, source_rate)
+            harmonized_path.parent.mkdir(exist_ok=True, parents=True)
+            tmp_path = harmonized_path.with_suffix(f'.{os.getpid()}.tmp')
+            with WavWriter(tmp_path, rate, channels, float32=True) as writer:
+                for block in iter_harmonized(samples, channels, rate // divisor, source_rate // divisor):
+                    writer.write(block)
+            os.replace(tmp_path, harmonized_path)
+    harmonize_src_track.paths[path] = harmonized_path
+    return harmonized_path
+
+
+harmonize_src_track.paths = {}
+
+
+def mix_layers(layer_ids, gains=None, block_frames=BLOCK_FRAMES):
+    '''
+    Sum the layers of a composite track with per-layer gains into a WAV file in the render cache, keyed by the layer hashes and gains
+    All layers start together, so they follow the loop points of the first layer, which also sets the length
+    The sum is stored as float, so peaks above full scale survive until the loudness gain is applied
+    '''
+    gains = gains or [1.0] * len(layer_ids)
+    if len(gains) != len(layer_ids):
+        raise RuntimeError(f'{"+".join(layer_ids)}: expected {len(layer_ids)} layer gains, got {len(gains)}')
+    paths = [find_src_track(layer_id) for layer_id in layer_ids]
+    key = hashlib.sha1(json.dumps([[hash_file(path) for path in paths], gains, 'float32']).encode('utf8')).hexdigest()
+    cache_path = Path(RENDER_CACHE_DIR) / f'{key}.wav'
+    if cache_path.exists():
+        # The modification time tracks the last use for eviction
+        cache_path.touch()
+        return cache_path
+    layers = [read_wav(path) for path in paths]
+    formats = {(rate, samples.shape[1]) for rate, samples in layers}
+    if len(formats) != 1:
+        raise RuntimeError(f'{"+".join(layer_ids)}: layers must share one sample rate and channel count, got {sorted(formats)}')
+    rate, channels = formats.pop()
+    frames = len(layers[0][1])
+    cache_path.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+    with WavWriter(tmp_path, rate, channels, float32=True) as writer:
+        for offset in range(0, frames, block_frames):
+            block = np.zeros((min(block_frames, frames - offset), channels), dtype=np.float32)
+            for (_, samples), gain in zip(layers, gains):
+                chunk = samples[offset:offset + len(block)]
+                block[:len(chunk)] += to_float(chunk) * gain
+            writer.write(block)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def get_entry_blocks(entry):
+    '''
+    Returns the source track and the (begin, duration) blocks in s making up a compilation entry
+    '''
+    path = find_src_track(entry['id'], layer_gains=entry.get('layer_gains'))
     duration_1, begin_2, duration_2 = get_range(entry["id"])
     if entry.get('intro', True):
         begin = 0.0
@@ -144,33 +835,230 @@ def load_and_process_entry(entry, output_file=None):
     if 'crossfade' in entry:
         begin -= entry['crossfade']
         duration += entry["crossfade"]
-    
-    # Trim initial block
-    cut_audio(path, output_file=output_file, begin=begin, duration=duration)
-
-    # Loop entry
-    with NamedTemporaryFile(suffix='.wav') as tmp_file:
-        tmp_file = Path(tmp_file.name)
-        for _ in range(entry.get('nloop', 0)):
-            cut_audio(path, output_file=tmp_file, begin=begin_2, duration=duration_2)
-            join_audio(output_file, tmp_file, output_file=output_file)
-            duration += duration_2
+    return path, [(begin, duration)] + [(begin_2, duration_2)] * entry.get('nloop', 0)
+
+
+def get_crossfades(entries, curve='tri'):
+    '''
+    Returns the overlap in s of every entry with its predecessor and the curves they are mixed with
+    The first entry has nothing to mix into
+    '''
+    crossfades = [entry.get('crossfade', 0.0) if i else 0.0 for i, entry in enumerate(entries)]
+    return crossfades, [entry.get('crossfade_curve', curve) for entry in entries]
+
+
+def clamp_crossfades(frames, crossfades):
+    '''
+    Shorten crossfades in frames, so that an entry is never mixed into more than its own length
+    '''
+    clamped = []
+    for i, (entry_frames, crossfade) in enumerate(zip(frames, crossfades)):
+        clamped.append(min(crossfade, frames[i - 1] - clamped[i - 1], entry_frames) if i else 0)
+    return clamped
+
+
+def iter_crossfaded(entries, crossfades, curves):
+    '''
+    Yield the float blocks of consecutive (frames, blocks) entries, every entry is mixed into the end of its predecessor
+    over its crossfade frames (see clamp_crossfades), only the overlapping windows are held back
+    '''
+    held = None
+    for i, (frames, blocks) in enumerate(entries):
+        head_end = crossfades[i]
+        tail_begin = frames - (crossfades[i + 1] if i + 1 < len(entries) else 0)
+        head = []
+        tail = []
+        position = 0
+        for block in blocks:
+            end = position + len(block)
+            if position < head_end:
+                head.append(block[:head_end - position])
+                if end >= head_end:
+                    x = (np.arange(head_end) / head_end)[:, np.newaxis]
+                    yield held * CROSSFADE_CURVES[curves[i]](1 - x) + np.concatenate(head) * CROSSFADE_CURVES[curves[i]](x)
+            body = block[max(head_end - position, 0):max(tail_begin - position, 0)]
+            if len(body):
+                yield body
+            if end > tail_begin:
+                tail.append(block[max(tail_begin - position, 0):])
+            position = end
+        held = np.concatenate(tail) if tail else None
+
+
+def open_entry(entry):
+    '''
+    Returns sample rate, segments, fadeout in frames and duration in s of a compilation entry
+    '''
+    path, blocks = get_entry_blocks(entry)
+    rate, samples = read_wav(path)
+
+    # Trim initial block and loop entry, every loop repeat is a view of the same samples
+    segments = [cut_samples(samples, rate, begin=begin, duration=duration) for begin, duration in blocks]
 
     # Add fadeout to end
-    if 'fadeout' in entry:
-        fadeout_audio(output_file, output_file=output_file, begin=duration-entry['fadeout'], duration=entry['fadeout'])
-    
-    set_mean_volume(output_file, output_file=output_file)
+    fadeout = round(entry.get('fadeout', 0) * rate)
+
+    return rate, segments, fadeout, sum(duration for _, duration in blocks)
+
 
-    return duration
+def load_and_process_entry(entry, output_file=None, target=-14.0, measure='lufs', block_frames=BLOCK_FRAMES):
+    rate, segments, fadeout, duration = open_entry(entry)
 
-def postprocess_and_save_compilation(input_file, duration=0.0, config_path=None, meta_data={}, timestamps=[]):
+    # Set loudness
+    gain, stats = measure_entry(segments, rate, fadeout=fadeout, target=target, measure=measure, block_frames=block_frames)
+    with WavWriter(output_file, rate, segments[0].shape[1]) as writer:
+        for block in iter_blocks(segments, fadeout=fadeout, block_frames=block_frames):
+            writer.write(block * gain)
+
+    return duration, stats
+
+
+def get_entry_params(entry):
+    '''
+    Entry parameters that affect the rendered audio
+    '''
+    return {name: entry.get(name) for name in ('intro', 'nloop', 'fadeout', 'crossfade', 'layer_gains')}
+
+
+def get_entry_key(entry, path, blocks, target=-14.0, measure='lufs'):
+    '''
+    Content address of a rendered entry: source hash, resolved blocks and entry parameters
+    '''
+    key = json.dumps([hash_file(path), blocks, get_entry_params(entry), target, measure], sort_keys=True)
+    return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+
+def render_entry(entry, target=-14.0, measure='lufs', block_frames=BLOCK_FRAMES):
+    '''
+    Render an entry into the render cache unless it is already there
+    Returns the rendered file, the entry duration and its loudness statistics, which are cached next to the file
+    '''
+    path, blocks = get_entry_blocks(entry)
+    duration = sum(duration for _, duration in blocks)
+    cache_path = Path(RENDER_CACHE_DIR) / f'{get_entry_key(entry, path, blocks, target=target, measure=measure)}.wav'
+    stats_path = cache_path.with_suffix('.npz')
+    if cache_path.exists():
+        # The modification time tracks the last use for eviction
+        cache_path.touch()
+        with np.load(stats_path) as cache:
+            stats = {name: cache[name] for name in cache.files}
+        return cache_path, duration, stats
+    cache_path.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+    _, stats = load_and_process_entry(entry, output_file=tmp_path, target=target, measure=measure, block_frames=block_frames)
+    with stats_path.open('wb') as stream:
+        np.savez(stream, **stats)
+    os.replace(tmp_path, cache_path)
+    return cache_path, duration, stats
+
+
+def evict_render_cache(max_size=RENDER_CACHE_MAX_SIZE):
+    '''
+    Delete the least recently used renders until the cache fits into max_size bytes
+    '''
+    renders = [(path.stat(), path) for path in Path(RENDER_CACHE_DIR).glob('*.wav')]
+    size = sum(stat.st_size for stat, _ in renders)
+    for stat, path in sorted(renders, key=lambda render: render[0].st_mtime):
+        if size <= max_size:
+            break
+        path.unlink()
+        path.with_suffix('.npz').unlink(missing_ok=True)
+        size -= stat.st_size
+
+
+def build_filter_graph(entries, target=-14.0, measure='lufs', curve='tri'):
+    '''
+    Translate compilation entries into ffmpeg inputs and a single filter_complex graph with output [out]
+    Returns inputs, graph, entry durations and their loudness statistics
+    '''
+    plans = [get_entry_blocks(entry) for entry in entries]
+    # Each source is decoded once and split into one stream per trimmed block
+    inputs = list(dict.fromkeys(path for path, _ in plans))
+    streams = {path: [] for path in inputs}
+    for i, (path, blocks) in enumerate(plans):
+        streams[path].extend(f'[e{i}b{k}]' for k in range(min(len(blocks), 2)))
+    graph = [f'[{index}:a]asplit={len(streams[path])}{"".join(streams[path])}' for index, path in enumerate(inputs)]
+    durations = []
+    stats = []
+    runs = []
+    for i, (entry, (path, blocks)) in enumerate(zip(entries, plans)):
+        durations.append(sum(duration for _, duration in blocks))
+        rate, samples = read_wav(path)
+        segments = [cut_samples(samples, rate, begin=begin, duration=duration) for begin, duration in blocks]
+        fadeout = entry.get('fadeout', 0)
+        gain, entry_stats = measure_entry(segments, rate, fadeout=round(fadeout * rate), target=target, measure=measure)
+        stats.append(entry_stats)
+        (begin, duration), *loops = blocks
+        graph.append(f'[e{i}b0]atrim=start={max(begin, 0.0)}:duration={duration},asetpts=PTS-STARTPTS[e{i}i]')
+        if loops:
+            begin_2, duration_2 = loops[0]
+            # aloop repeats the trimmed loop block loop more times
+            graph.append(f'[e{i}b1]atrim=start={begin_2}:duration={duration_2},asetpts=PTS-STARTPTS,aloop=loop={len(loops) - 1}:size={len(segments[1])}[e{i}l]')
+            chain = f'[e{i}i][e{i}l]concat=n=2:v=0:a=1'
+        else:
+            chain = f'[e{i}i]anull'
+        if fadeout:
+            chain += f',afade=t=out:st={durations[-1] - fadeout}:d={fadeout}'
+        graph.append(f'{chain},volume={gain}[e{i}]')
+        # Entries with crossfade start a new run that is mixed into the previous one
+        if not runs or 'crossfade' in entry:
+            runs.append((entry.get('crossfade'), entry.get('crossfade_curve', curve), []))
+        runs[-1][2].append(f'[e{i}]')
+    output = None
+    for k, (crossfade, run_curve, labels) in enumerate(runs):
+        graph.append(f'{"".join(labels)}concat=n={len(labels)}:v=0:a=1[r{k}]')
+        if output is None:
+            output = f'[r{k}]'
+        else:
+            graph.append(f'{output}[r{k}]acrossfade=d={crossfade}:c1={run_curve}:c2={run_curve}[x{k}]')
+            output = f'[x{k}]'
+    graph.append(f'{output}anull[out]')
+    return inputs, ';\n'.join(graph), durations, stats
+
+
+def render_compilation_graph(entries, output_file, target=-14.0, measure='lufs', curve='tri'):
+    '''
+    Render the whole compilation in a single ffmpeg process, returns the entry durations and their loudness statistics
+    '''
+    inputs, graph, durations, stats = build_filter_graph(entries, target=target, measure=measure, curve=curve)
+    with TemporaryDirectory() as tmp_dir:
+        graph_file = Path(tmp_dir) / 'graph.txt'
+        graph_file.write_text(graph, encoding='utf8')
+        ffmpeg(*inputs, output_file=output_file, options=['-filter_complex_script', graph_file, '-map', '[out]', '-c:a', 'pcm_s16le'], stderr=subprocess.DEVNULL)
+    return durations, stats
+
+
+def encode_still_video(image_file, audio_file, output_file, duration=0.0, gain=1.0):
+    '''
+    Encode the still image once as a single GOP segment and repeat it by stream copy for the duration of the audio
+    The audio is either a WAV file or a BlockProducer that is piped into the encoder
+    '''
+    with TemporaryDirectory() as tmp_dir:
+        segment_file = Path(tmp_dir) / 'segment.mp4'
+        ffmpeg(image_file, output_file=segment_file, pre_options=['-loop', '1', '-framerate', '1'], options=['-t', str(STILL_SEGMENT_DURATION), '-g', str(STILL_SEGMENT_DURATION), '-c:v', 'libx264', '-preset', 'medium', '-tune', 'stillimage', '-crf', '18', '-pix_fmt', 'yuv420p'], stderr=subprocess.DEVNULL)
+        # Paths in the concat list are relative to the list file
+        list_file = Path(tmp_dir) / 'segments.txt'
+        list_file.write_text(f"file '{segment_file.name}'\n" * (int(duration // STILL_SEGMENT_DURATION) + 1))
+        # Files beyond 4 GiB have no valid data size, so the audio is read up to EOF
+        input_options = [['-f', 'concat', '-safe', '0'], ['-ignore_length', '1']]
+        options = ['-map', '0:v', '-map', '1:a', '-t', str(duration), '-af', f'volume={gain}', '-c:v', 'copy', '-c:a', 'aac']
+        if not isinstance(audio_file, BlockProducer):
+            ffmpeg(list_file, audio_file, output_file=output_file, input_options=input_options, options=options)
+            return
+        with audio_file:
+            ffmpeg(list_file, 'pipe:0', output_file=output_file, input_options=input_options, options=options, stdin=audio_file.read_fd)
+        # A failed producer ends the stream early, which ffmpeg takes as a short input
+        if audio_file.error is not None:
+            output_file.unlink(missing_ok=True)
+            raise audio_file.error
+
+
+def postprocess_and_save_compilation(input_file, duration=0.0, config_path=None, meta_data={}, timestamps=[], gain=1.0):
     description = meta_data['description'].format(timestamps='\n'.join(timestamps))
     output_dir = Path(TARGET_OUTPUT_DIR) / config_path.stem
     output_dir.mkdir(exist_ok=True, parents=True)
-    set_mean_volume(input_file, output_file=input_file)
     #shutil.copyfile(input_file, output_dir / 'video.wav')
-    ffmpeg(Path(IMAGES_DIR) / meta_data['image'], input_file, output_file=output_dir / 'video.mp4', pre_options=['-loop', '1', '-framerate', '1'], options=['-t', str(duration), '-c:v', 'libx264', '-preset', 'medium', '-tune', 'stillimage', '-crf', '18', '-c:a', 'aac', '-pix_fmt', 'yuv420p'])
+    encode_still_video(Path(IMAGES_DIR) / meta_data['image'], input_file, output_dir / 'video.mp4', duration=duration, gain=gain)
     with open(output_dir / 'title.txt', 'w', encoding='utf8') as stream:
         stream.write(meta_data['title'])
     with open(output_dir / 'tags.txt', 'w', encoding='utf8') as stream:
@@ -179,33 +1067,152 @@ def postprocess_and_save_compilation(input_file, duration=0.0, config_path=None,
         stream.write(description)
     shutil.move(config_path, Path(TARGET_CONFIGS['committed_dir']) / config_path.name)
 
-if __name__ == '__main__':
+def save_compilation(input_file, config_path=None, target_config={}, durations=[], stats=[], crossfades=None, curves=None, target=-14.0, measure='lufs'):
+    # The compilation gain follows from the entry statistics, so the audio is only touched by the final encode
+    crossfades = crossfades or [0.0] * len(stats)
+    stats = combine_loudness_stats(stats, crossfades, curves)
+    gain = get_gain(get_stats_loudness(stats, measure=measure), target=target)
+    timestamps = []
+    time = 0.0
+    for entry, duration, crossfade in zip(target_config['compilation'], durations, crossfades):
+        # An entry starts when it begins to fade in over its predecessor
+        time -= crossfade
+        timestamp = f'{str(timedelta(seconds=time)).split(".")[0]} - {entry["name"]}'
+        print(timestamp)
+        timestamps.append(timestamp)
+        time += duration
+
+    postprocess_and_save_compilation(input_file, duration=time, config_path=config_path, meta_data=target_config['meta_data'], timestamps=timestamps, gain=gain)
+
+
+def assemble_and_save_compilation(config_path, target_config, rendered, target=-14.0, measure='lufs', curve='tri', block_frames=BLOCK_FRAMES):
+    '''
+    Join the rendered entries in config order with their crossfades mixed in, then encode and commit the compilation
+    '''
+    sources = [read_wav(entry_file) for entry_file, _, _ in rendered]
+    formats = {(rate, samples.shape[1]) for rate, samples in sources}
+    if len(formats) != 1:
+        raise RuntimeError(f'{config_path}: entries must share one sample rate and channel count, got {sorted(formats)}')
+    rate, channels = formats.pop()
+    frames = [len(samples) for _, samples in sources]
+    crossfades, curves = get_crossfades(target_config['compilation'], curve=curve)
+    crossfades = clamp_crossfades(frames, [round(crossfade * rate) for crossfade in crossfades])
+    entries = [(len(samples), iter_blocks([samples], block_frames=block_frames)) for _, samples in sources]
     with TemporaryDirectory() as tmp_dir:
-        input_file = Path(tmp_dir) / 'inp.wav'
         output_file = Path(tmp_dir) / 'out.wav'
-        Path(TARGET_CONFIGS['committed_dir']).mkdir(exist_ok=True)
-        for config_path in list(Path(TARGET_CONFIGS['staged_dir']).glob('*.json')):
-            with config_path.open('r') as stream:
-                target_config = json.load(stream)
-            timestamps = []
-            first = True
-            time = timedelta()
-            for entry in target_config['compilation']:
-                timestamp = f'{str(time).split(".")[0]} - {entry["name"]}'
-                print(timestamp)
-                timestamps.append(timestamp)
-                duration = load_and_process_entry(entry, output_file=input_file)
-
-                if 'crossfade' in entry:
-                    time += timedelta(seconds=duration-entry['crossfade'])
-                else:
-                    time += timedelta(seconds=duration)
+        with WavWriter(output_file, rate, channels) as writer:
+            for block in iter_crossfaded(entries, crossfades, curves):
+                writer.write(block)
+        save_compilation(output_file, config_path=config_path, target_config=target_config, durations=[n / rate for n in frames], stats=[stats for _, _, stats in rendered], crossfades=[n / rate for n in crossfades], curves=curves, target=target, measure=measure)
 
-                # Append entry to stream
-                if first:
-                    shutil.move(input_file, output_file)
-                    first = False
+
+def iter_entry_blocks(entry, gain=1.0, block_frames=BLOCK_FRAMES):
+    _, segments, fadeout, _ = open_entry(entry)
+    for block in iter_blocks(segments, fadeout=fadeout, block_frames=block_frames):
+        yield block * gain
+
+
+def stream_and_save_compilation(config_path, target=-14.0, measure='lufs', curve='tri', block_frames=BLOCK_FRAMES):
+    '''
+    Measure the entries, then render them in config order on a producer thread that feeds the final encode
+    The compilation is never written as WAV file
+    '''
+    with config_path.open('r') as stream:
+        target_config = json.load(stream)
+    gains, frames, stats, formats = [], [], [], set()
+    for entry in target_config['compilation']:
+        rate, segments, fadeout, _ = open_entry(entry)
+        gain, entry_stats = measure_entry(segments, rate, fadeout=fadeout, target=target, measure=measure, block_frames=block_frames)
+        gains.append(gain)
+        frames.append(sum(len(segment) for segment in segments))
+        stats.append(entry_stats)
+        formats.add((rate, segments[0].shape[1]))
+    if len(formats) != 1:
+        raise RuntimeError(f'{config_path}: entries must share one sample rate and channel count, got {sorted(formats)}')
+    rate, channels = formats.pop()
+    crossfades, curves = get_crossfades(target_config['compilation'], curve=curve)
+    crossfades = clamp_crossfades(frames, [round(crossfade * rate) for crossfade in crossfades])
+    entries = [
+        (entry_frames, iter_entry_blocks(entry, gain, block_frames=block_frames))
+        for entry, entry_frames, gain in zip(target_config['compilation'], frames, gains)
+    ]
+    producer = BlockProducer(iter_crossfaded(entries, crossfades, curves), rate, channels)
+    save_compilation(producer, config_path=config_path, target_config=target_config, durations=[n / rate for n in frames], stats=stats, crossfades=[n / rate for n in crossfades], curves=curves, target=target, measure=measure)
+
+
+def compile_configs(config_paths, jobs=1, target=-14.0, measure='lufs', curve='tri', block_frames=BLOCK_FRAMES):
+    '''
+    Build several target configs at once with at most jobs concurrent tasks
+    Entries shared between configs are rendered once and each config is assembled and committed as soon as its entries are rendered
+    '''
+    target_configs = {}
+    for config_path in config_paths:
+        with config_path.open('r') as stream:
+            target_configs[config_path] = json.load(stream)
+    entry_keys = {
+        config_path: [json.dumps([entry['id'], get_entry_params(entry)], sort_keys=True) for entry in target_config['compilation']]
+        for config_path, target_config in target_configs.items()
+    }
+    unique_entries = {}
+    for config_path, keys in entry_keys.items():
+        for key, entry in zip(keys, target_configs[config_path]['compilation']):
+            unique_entries.setdefault(key, entry)
+    pending_renders = deque(unique_entries.items())
+    pending_configs = deque(config_path for config_path, keys in entry_keys.items() if not keys)
+    rendered = {}
+    running = {}
+    with ProcessPoolExecutor(jobs, initializer=set_src_tracks, initargs=(index_src_tracks(),)) as executor:
+        while pending_renders or pending_configs or running:
+            # Finishing configs takes priority over further renders
+            while len(running) < jobs and (pending_configs or pending_renders):
+                if pending_configs:
+                    config_path = pending_configs.popleft()
+                    future = executor.submit(assemble_and_save_compilation, config_path, target_configs[config_path], [rendered[key] for key in entry_keys.pop(config_path)], target=target, measure=measure, curve=curve, block_frames=block_frames)
+                    running[future] = (config_path, None)
                 else:
-                    join_audio(output_file, input_file, output_file=output_file)
+                    key, entry = pending_renders.popleft()
+                    running[executor.submit(render_entry, entry, target=target, measure=measure, block_frames=block_frames)] = (key, entry)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, entry = running.pop(future)
+                result = future.result()
+                if entry is None:
+                    print(f'Committed {name.name}')
+                    continue
+                print(f'Rendered {entry["name"]}')
+                rendered[name] = result
+                for config_path, keys in entry_keys.items():
+                    if config_path not in pending_configs and all(key in rendered for key in keys):
+                        pending_configs.append(config_path)
+    evict_render_cache()
+
 
-            postprocess_and_save_compilation(output_file, duration=time.total_seconds(), config_path=config_path, meta_data=target_config['meta_data'], timestamps=timestamps)
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--backend', choices=['numpy', 'stream', 'ffmpeg'], default='numpy', help='Render entries in-process, in-process straight into the encoder or as one ffmpeg filter graph')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of concurrent render and encode tasks of the numpy and stream backends')
+    parser.add_argument('--loudness', choices=['lufs', 'mean'], default='lufs', help='Loudness measure: BS.1770 integrated loudness or mean volume like volumedetect')
+    parser.add_argument('--target', type=float, default=-14.0, help='Loudness target in LUFS or dB')
+    parser.add_argument('--crossfade-curve', choices=list(CROSSFADE_CURVES), default='tri', help='Crossfade curve of entries without crossfade_curve')
+    parser.add_argument('--block-frames', type=int, default=BLOCK_FRAMES, help='Frames per rendered block, bounds the memory use of the numpy and stream backends')
+    args = parser.parse_args()
+    Path(TARGET_CONFIGS['committed_dir']).mkdir(exist_ok=True)
+    config_paths = list(Path(TARGET_CONFIGS['staged_dir']).glob('*.json'))
+    if args.backend == 'ffmpeg':
+        with TemporaryDirectory() as tmp_dir:
+            output_file = Path(tmp_dir) / 'out.wav'
+            for config_path in config_paths:
+                with config_path.open('r') as stream:
+                    target_config = json.load(stream)
+                durations, stats = render_compilation_graph(target_config['compilation'], output_file, target=args.target, measure=args.loudness, curve=args.crossfade_curve)
+                # acrossfade mixes every entry with a crossfade into its predecessor
+                crossfades, curves = get_crossfades(target_config['compilation'], curve=args.crossfade_curve)
+                save_compilation(output_file, config_path=config_path, target_config=target_config, durations=durations, stats=stats, crossfades=crossfades, curves=curves, target=args.target, measure=args.loudness)
+    elif args.backend == 'stream':
+        with ProcessPoolExecutor(args.jobs, initializer=set_src_tracks, initargs=(index_src_tracks(),)) as executor:
+            futures = {executor.submit(stream_and_save_compilation, config_path, target=args.target, measure=args.loudness, curve=args.crossfade_curve, block_frames=args.block_frames): config_path for config_path in config_paths}
+            for future in as_completed(futures):
+                future.result()
+                print(f'Committed {futures[future].name}')
+    else:
+        compile_configs(config_paths, jobs=args.jobs, target=args.target, measure=args.loudness, curve=args.crossfade_curve, block_frames=args.block_frames)
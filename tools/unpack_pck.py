@@ -1,8 +1,26 @@
 from pathlib import Path
+import os
+import mmap
 import struct
 import subprocess
+import sys
+import json
+import hashlib
+import sqlite3
+import xml.etree.ElementTree as ET
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, closing, contextmanager
+from tempfile import TemporaryDirectory
+import numpy as np
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
 
+GAME_DIRS = [Path(__file__).resolve().parent.parent / game for game in ('rise', 'world')]
+MANIFEST_NAME = 'manifest.json'
+WW2OGG = ['./ww2ogg/ww2ogg.exe', '--pcb', 'ww2ogg/packed_codebooks_aoTuV_603.bin']
 ENDIANNESS = '<' # Little endian
 STRUCT_SIGNS = {
 	1 : 'c',
@@ -11,59 +29,343 @@ STRUCT_SIGNS = {
 	8 : 'Q'
 }
 
+# Sound table entries are 20 bytes
+WEM_DTYPE = np.dtype([
+    ('id', ENDIANNESS + 'u4'),
+    ('type', ENDIANNESS + 'u4'),
+    ('length', ENDIANNESS + 'u4'),
+    ('offset', ENDIANNESS + 'u4'),
+    ('padding', ENDIANNESS + 'u4'),
+])
+
+# Bank data index entries are 12 bytes, offsets are relative to the DATA chunk
+DIDX_DTYPE = np.dtype([
+    ('id', ENDIANNESS + 'u4'),
+    ('offset', ENDIANNESS + 'u4'),
+    ('length', ENDIANNESS + 'u4'),
+])
+
 def unpack(_bytes):
     return struct.unpack(ENDIANNESS + STRUCT_SIGNS[len(_bytes)], _bytes)[0]
 
-def set_pointer(file):
-    if file.read(4) != b'AKPK':
-        log("Error, this file does not have a valid AKPK header!", -1)
+def get_table_offset(data):
+    if data[:4] != b'AKPK':
+        raise ValueError("Error, this file does not have a valid AKPK header!")
 
-    file.read(8) # Padding
-    file.seek(25 + unpack(file.read(4))) # 25 skips to the sfx header
+    # 4 bytes magic and 8 bytes padding, 25 skips to the sfx header
+    offset = 25 + unpack(data[12:16])
+    # Handles for Magic Arena files
+    offset += 4 + (23 if unpack(data[offset:offset + 4]) != 0 else 3)
+    return offset
 
-def extract(wems, file, out_path):
-    # Create directory for the extracted files
-    out_path.mkdir(exist_ok=True)
+def get_bank_chunks(data):
+    # Banks are a sequence of chunks with 4 bytes tag and 4 bytes size
+    chunks = {}
+    offset = 0
+    while offset + 8 <= len(data):
+        size = unpack(data[offset + 4:offset + 8])
+        chunks[bytes(data[offset:offset + 4])] = (offset + 8, size)
+        offset += 8 + size
+    return chunks
+
+def read_bank_wems(data):
+    '''
+    Get the WEMs embedded in a sound bank as sound table
+    '''
+    chunks = get_bank_chunks(data)
+    if b'DIDX' not in chunks or b'DATA' not in chunks:
+        return np.zeros(0, dtype=WEM_DTYPE)
+    didx_offset, didx_size = chunks[b'DIDX']
+    data_offset, _ = chunks[b'DATA']
+    didx = np.frombuffer(data, dtype=DIDX_DTYPE, count=didx_size // DIDX_DTYPE.itemsize, offset=didx_offset)
+    wems = np.zeros(len(didx), dtype=WEM_DTYPE)
+    wems['id'] = didx['id']
+    wems['length'] = didx['length']
+    wems['offset'] = didx['offset'] + data_offset
+    return wems
+
+def read_wems(data):
+    if data[:4] == b'BKHD':
+        return read_bank_wems(data)
+    offset = get_table_offset(data)
+    count = unpack(data[offset:offset + 4])
+    # Copy the small table, so it does not pin the memory map
+    return np.frombuffer(data, dtype=WEM_DTYPE, count=count, offset=offset + 4).copy()
+
+def read_bank_source_ids(data):
+    '''
+    Get the sourceIDs of the music track objects in the HIRC chunk of a sound bank
+    '''
+    chunks = get_bank_chunks(data)
+    if b'BKHD' not in chunks or b'HIRC' not in chunks:
+        return set()
+    version = unpack(data[chunks[b'BKHD'][0]:chunks[b'BKHD'][0] + 4])
+    offset, _ = chunks[b'HIRC']
+    num_objects = unpack(data[offset:offset + 4])
+    offset += 4
+    source_ids = set()
+    for _ in range(num_objects):
+        obj_type, size = data[offset], unpack(data[offset + 1:offset + 5])
+        offset += 5
+        # CAkMusicTrack, the body starts with its id followed by uFlags on newer versions
+        if obj_type == 11:
+            source_offset = offset + 4 + (1 if version > 112 else 0)
+            num_sources = unpack(data[source_offset:source_offset + 4])
+            source_offset += 4
+            for _ in range(num_sources):
+                # AkBankSourceData: ulPluginID, StreamType, sourceID, uInMemoryMediaSize, uSourceBits
+                plugin_id = unpack(data[source_offset:source_offset + 4])
+                source_ids.add(str(unpack(data[source_offset + 5:source_offset + 9])))
+                source_offset += 14
+                # Source plugins carry their parameters
+                if plugin_id & 0xF == 2:
+                    source_offset += 4 + unpack(data[source_offset:source_offset + 4])
+        offset += size
+    return source_ids
 
-    print(f"Log: Extracting {len(wems)} sound files..")
+def get_referenced_ids(game_dirs):
+    '''
+    Collect the sound ids used by the target configs, HIRC dumps and sound banks of the given game directories
+    '''
+    ids = set()
+    for game_dir in game_dirs:
+        for path in game_dir.glob('target-configs/**/*.json'):
+            with path.open('r') as stream:
+                config = json.load(stream)
+            compilation = config.get('compilation', [])
+            # Older configs map ids to their entries
+            track_ids = compilation.keys() if isinstance(compilation, dict) else [entry['id'] for entry in compilation]
+            for track_id in track_ids:
+                ids.update(track_id.split('+'))
+        for path in game_dir.glob('src-track-configs/*.json'):
+            with path.open('r') as stream:
+                ids.update(json.load(stream))
+        for path in game_dir.glob('src-track-configs/*.xml'):
+            for _, node in ET.iterparse(path):
+                if node.tag == 'fld' and node.attrib.get('na') == 'sourceID':
+                    ids.add(node.attrib['va'])
+                node.clear()
+        # Sound banks are read directly, e.g. *_str*.bnk.* and *_cmn.nbnk.*
+        for path in game_dir.glob('src-track-configs/*.*bnk*'):
+            if path.suffix == '.npz':
+                continue
+            with path.open('rb') as stream, mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                ids.update(read_bank_source_ids(data))
+    # Named tracks are not part of any pck
+    return np.array(sorted({int(i) for i in ids if i.isdigit()}), dtype=np.uint32)
 
-    # Create the .wem files
-    for w in wems:
-        file.seek(wems[w]['offset'])
-        data = file.read(wems[w]['length'])
-        Path(out_path.joinpath(str(w) + '.wem')).write_bytes(data)
+def get_codec(data, offset):
+    # Format tag of the RIFF fmt chunk, e.g. 0xFFFF for Wwise Vorbis
+    if data[offset:offset + 4] != b'RIFF' or data[offset + 12:offset + 16] != b'fmt ':
+        return None
+    return unpack(data[offset + 20:offset + 22])
 
-    # Convert the .wem files to .ogg
-    for f in sorted(out_path.glob('*.wem')):
-        subprocess.check_output(['./ww2ogg/ww2ogg.exe', f, '--pcb', 'ww2ogg/packed_codebooks_aoTuV_603.bin'], stderr=subprocess.DEVNULL)
-        subprocess.check_output(['ffmpeg', '-i', f.with_suffix('.ogg'), f.with_suffix('.wav')], stderr=subprocess.DEVNULL)
-        f.unlink()
-        f.with_suffix('.ogg').unlink()
+def build_catalog(pck_paths, catalog_path):
+    '''
+    Map the sound ids of the given pck files to their location, only the sound tables and RIFF headers are read
+    '''
+    with closing(sqlite3.connect(catalog_path)) as catalog, catalog:
+        catalog.execute('CREATE TABLE IF NOT EXISTS wems (id INTEGER, pck TEXT, offset INTEGER, length INTEGER, codec INTEGER, PRIMARY KEY (id, pck))')
+        for pck_path in pck_paths:
+            pck_path = pck_path.resolve()
+            with pck_path.open('rb') as stream, mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                wems = read_wems(data)
+                rows = [
+                    (wem_id, str(pck_path), offset, length, get_codec(data, offset))
+                    for wem_id, length, offset in zip(wems['id'].tolist(), wems['length'].tolist(), wems['offset'].tolist())
+                ]
+            catalog.execute('DELETE FROM wems WHERE pck = ?', (str(pck_path),))
+            catalog.executemany('INSERT OR REPLACE INTO wems VALUES (?, ?, ?, ?, ?)', rows)
+            print(f"Log: Cataloged {len(rows)} sound files of {pck_path.name}..")
+
+def load_manifest(out_path):
+    manifest_path = out_path / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {}
+    with manifest_path.open('r') as stream:
+        return json.load(stream)
+
+@contextmanager
+def lock_manifest(out_path):
+    # Concurrent runs on the same directory, e.g. lazy extraction by several render workers, wait for each other
+    with open(out_path / f'{MANIFEST_NAME}.lock', 'wb') as stream:
+        if os.name == 'nt':
+            while True:
+                try:
+                    # Gives up after 10 attempts
+                    msvcrt.locking(stream.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                msvcrt.locking(stream.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(stream, fcntl.LOCK_EX)
+            yield
+
+def save_manifest(out_path, updates):
+    '''
+    Merge updates (a record, or None for a removed sound file) into the manifest under a lock,
+    so concurrent runs keep each other's records
+    '''
+    with lock_manifest(out_path):
+        manifest = load_manifest(out_path)
+        for wem_id, record in updates.items():
+            if record is None:
+                manifest.pop(wem_id, None)
+            else:
+                manifest[wem_id] = record
+        tmp_path = out_path / f'{MANIFEST_NAME}.{os.getpid()}.tmp'
+        with tmp_path.open('w') as stream:
+            json.dump(manifest, stream, indent=4, sort_keys=True)
+        os.replace(tmp_path, out_path / MANIFEST_NAME)
+
+def remove_stale(manifest, wem_ids, out_path, pck_name, updates):
+    # Sound files that are no longer part of the pck, several pcks (e.g. bgm.pck.1 and bgm.pck.2) can share the output directory
+    extracted = {wem_id for wem_id, record in manifest.items() if record.get('pck') == pck_name}
+    for wem_id in extracted - {str(wem_id) for wem_id in wem_ids.tolist()}:
+        out_path.joinpath(f'{wem_id}.wav').unlink(missing_ok=True)
+        updates[wem_id] = None
+
+def extract(wems, data, out_path, pck_name, manifest, updates):
+    '''
+    Get the conversion tasks for new or changed sound files and add their records to the manifest updates
+    '''
+    # Create directory for the extracted files
+    out_path.mkdir(exist_ok=True)
 
-def process_pck(pck_path, out_path):
-    with pck_path.open('rb') as stream:
-        set_pointer(stream)
-        stream.read(23) if unpack(stream.read(4)) != 0 else stream.read(3) # Handles for Magic Arena files
+    # Conversion tasks read the .wem data straight from the memory map
+    tasks = []
+    with memoryview(data) as view:
+        for wem_id, length, offset in zip(wems['id'].tolist(), wems['length'].tolist(), wems['offset'].tolist()):
+            wav_path = out_path.joinpath(f'{wem_id}.wav')
+            record = {
+                'pck': pck_name,
+                'offset': offset,
+                'length': length,
+                'sha1': hashlib.sha1(view[offset:offset + length]).hexdigest(),
+            }
+            if manifest.get(str(wem_id), {}).get('sha1') == record['sha1'] and wav_path.exists():
+                continue
+            updates[str(wem_id)] = record
+            tasks.append((data, offset, length, wav_path))
 
-        # Get wems
-        wems = {}
-        for i in range(unpack(stream.read(4))):
-            wem_id = unpack(stream.read(4))
-            wem_type = unpack(stream.read(4))
-            wem_length = unpack(stream.read(4))
-            wem_offset = unpack(stream.read(4))
+    print(f"Log: Extracting {len(tasks)} of {len(wems)} sound files..")
+    return tasks
 
-            stream.read(4) # Padding
+def convert_wem(data, offset, length, wav_path):
+    # ww2ogg needs a seekable input, so the .wem goes to a scratch file, but only the .wav is written to the output directory
+    with TemporaryDirectory() as tmp_dir:
+        wem_path = Path(tmp_dir) / 'input.wem'
+        ogg_path = Path(tmp_dir) / 'output.ogg'
+        # The .wav is renamed into place when complete, so concurrent extractions of the same sound file do not clash
+        tmp_path = wav_path.with_name(f'{wav_path.stem}.{os.getpid()}.tmp')
+        with memoryview(data) as view:
+            wem_path.write_bytes(view[offset:offset + length])
+        ww2ogg = [WW2OGG[0], wem_path, '-o', ogg_path, *WW2OGG[1:]]
+        try:
+            if not hasattr(os, 'mkfifo'):
+                subprocess.check_output(ww2ogg, stderr=subprocess.DEVNULL)
+                subprocess.check_output(['ffmpeg', '-nostdin', '-y', '-f', 'ogg', '-i', ogg_path, '-f', 'wav', tmp_path], stderr=subprocess.DEVNULL)
+                os.replace(tmp_path, wav_path)
+                return
+            # Stream the .ogg into ffmpeg through a named pipe (ww2ogg prints its log to stdout)
+            # Both ends are opened here, so no open blocks and ffmpeg gets EOF once ww2ogg has exited, whether it opened the pipe or not
+            os.mkfifo(ogg_path)
+            read_fd = os.open(ogg_path, os.O_RDONLY | os.O_NONBLOCK)
+            write_fd = os.open(ogg_path, os.O_WRONLY)
+            os.set_blocking(read_fd, True)
+            ffmpeg = ['ffmpeg', '-y', '-f', 'ogg', '-i', 'pipe:0', '-f', 'wav', tmp_path]
+            try:
+                decoder = subprocess.Popen(ffmpeg, stdin=read_fd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError:
+                os.close(write_fd)
+                raise
+            finally:
+                os.close(read_fd)
+            try:
+                subprocess.check_output(ww2ogg, stderr=subprocess.DEVNULL)
+            except (subprocess.CalledProcessError, OSError):
+                decoder.kill()
+                raise
+            finally:
+                os.close(write_fd)
+                decoder.wait()
+            if decoder.returncode != 0:
+                raise subprocess.CalledProcessError(decoder.returncode, ffmpeg)
+            os.replace(tmp_path, wav_path)
+        except (subprocess.CalledProcessError, OSError):
+            tmp_path.unlink(missing_ok=True)
+            raise
 
-            wems[wem_id] = {'length' : wem_length, 'offset' : wem_offset}
+def convert_wems(tasks, jobs=1):
+    # The conversion runs in subprocesses, so threads are enough to keep jobs converters busy
+    failures = []
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = {executor.submit(convert_wem, *task): task[-1] for task in sorted(tasks, key=lambda task: task[-1])}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                future.result()
+            except (subprocess.CalledProcessError, OSError) as error:
+                failures.append(futures[future])
+                print(f"\nError: {futures[future]}: {error}")
+            print(f"Log: Processed {done}/{len(futures)} sound files..", end='\r')
+    print()
+    return failures
 
-        extract(wems, stream, out_path)
+def process_pck(pck_path, out_path, stack, ids=None):
+    # The memory map stays open until the stack is closed after the conversion
+    stream = stack.enter_context(pck_path.open('rb'))
+    data = stack.enter_context(mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ))
+    wems = read_wems(data)
+    # The manifest is only read here, changes are merged by save_manifest
+    manifest = load_manifest(out_path)
+    updates = {}
+    remove_stale(manifest, wems['id'], out_path, pck_path.name, updates)
+    if ids is not None:
+        wems = wems[np.isin(wems['id'], ids)]
+    return extract(wems, data, out_path, pck_path.name, manifest, updates), updates
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('files', nargs='+', type=Path)
-    parser.add_argument('-o', '--output', type=Path, required=True)
+    parser.add_argument('-o', '--output', type=Path)
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of sound files converted concurrently')
+    parser.add_argument('-r', '--referenced', action='store_true', help='Only extract sound files referenced by the target configs and HIRC dumps')
+    parser.add_argument('--games', nargs='+', type=Path, default=GAME_DIRS, help='Game directories searched for references')
+    parser.add_argument('--ids', nargs='+', type=int, help='Only extract the given sound ids')
+    parser.add_argument('--catalog', type=Path, help='Only add the sound tables to the given catalog database')
     args = parser.parse_args()
-    for path in args.files:
-        process_pck(path, args.output / path.stem)
\ No newline at end of file
+    if args.catalog is not None:
+        build_catalog(args.files, args.catalog)
+        sys.exit()
+    if args.output is None:
+        parser.error('the following arguments are required: -o/--output')
+    ids = None
+    if args.referenced:
+        ids = get_referenced_ids(args.games)
+        print(f"Log: Found {len(ids)} referenced sound ids..")
+    if args.ids is not None:
+        ids = np.union1d(ids if ids is not None else [], np.array(args.ids, dtype=np.uint32)).astype(np.uint32)
+    with ExitStack() as stack:
+        tasks = []
+        updates = {}
+        for path in args.files:
+            out_path = args.output / path.stem
+            pck_tasks, pck_updates = process_pck(path, out_path, stack, ids=ids)
+            updates.setdefault(out_path, {}).update(pck_updates)
+            tasks.extend(pck_tasks)
+        failures = convert_wems(tasks, jobs=args.jobs)
+    # Failed sound files are retried on the next run
+    for f in failures:
+        updates[f.parent][f.stem] = None
+    for out_path, pck_updates in updates.items():
+        save_manifest(out_path, pck_updates)
+    if failures:
+        print(f"Error: {len(failures)} of {len(tasks)} sound files failed to convert:")
+        for f in failures:
+            print(f"  {f}")
+        sys.exit(1)
\ No newline at end of file